@@ -2,19 +2,31 @@
 # -*- coding: utf-8 -*-
 
 import os
-import json
+import asyncio
+import hmac
 import math
+import re
+import threading
+import time
 import traceback
-from datetime import datetime, timedelta, timezone
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import asynccontextmanager, contextmanager
+from functools import lru_cache
+from html import escape
+from urllib.parse import urlencode
+from datetime import datetime, timezone
+from zoneinfo import ZoneInfo
 
 import httpx
+import orjson
 import psycopg2
+import psycopg2.extensions
 import psycopg2.extras
-from fastapi import FastAPI, Request, Header, Query
-from fastapi.responses import JSONResponse, HTMLResponse, PlainTextResponse
+import psycopg2.pool
+from fastapi import BackgroundTasks, FastAPI, Request, Header, Query
+from fastapi.responses import JSONResponse, HTMLResponse, ORJSONResponse, PlainTextResponse
 from pydantic import BaseModel
 from dotenv import load_dotenv
-import pytz
 import jdatetime
 
 # ─────────────────────────────────────────────────────────────
@@ -25,96 +37,297 @@ load_dotenv()
 BOT_TOKEN = os.getenv("TELEGRAM_BOT_TOKEN", "")
 TG_API = f"https://api.telegram.org/bot{BOT_TOKEN}"
 TG_WEBHOOK_SECRET = os.getenv("TELEGRAM_WEBHOOK_SECRET", "")
+# اگر ست شود، سیگنال‌ها یک بار در این کانال (@name یا -100…) ارسال می‌شوند به‌جای پیام به تک‌تک کاربران
+TG_SIGNALS_CHANNEL = os.getenv("TELEGRAM_SIGNALS_CHANNEL", "").strip()
 WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET", "")
 DATABASE_URL = os.getenv("DATABASE_URL", "")
 ADMIN_PANEL_TOKEN = os.getenv("ADMIN_PANEL_TOKEN", "")
 TRIAL_DAYS = int(os.getenv("TRIAL_DAYS", "7"))
+ACTIVE_USERS_TTL = int(os.getenv("ACTIVE_USERS_TTL", "60"))
+LAST_SIGNALS_TTL = int(os.getenv("LAST_SIGNALS_TTL", "30"))
+RUN_MIGRATIONS = os.getenv("RUN_MIGRATIONS", "true").lower() == "true"
 CRON_TOKEN = os.getenv("CRON_TOKEN", "Nw8CnNI4dfwWLwGJQuxBt4hI_XAM7W9ZHx1Yk")
 
+# Pool size: (cores * 2) + 1 is a good default for small OLTP queries
+DB_POOL_MIN = int(os.getenv("DB_POOL_MIN", "5"))
+DB_POOL_MAX = int(os.getenv("DB_POOL_MAX", str(max(DB_POOL_MIN, (os.cpu_count() or 1) * 2 + 1))))
+# پشت PgBouncer در حالت transaction pooling باید false باشد (PREPARE به session وابسته است)
+DB_PREPARE_STATEMENTS = os.getenv("DB_PREPARE_STATEMENTS", "true").lower() == "true"
+
 SHOW_FIXED_SLTP = os.getenv("SHOW_FIXED_SLTP", "true").lower() == "true"
 FIXED_SL_PCT = float(os.getenv("FIXED_SL_PCT", "0.02"))
 FIXED_TP_PCT = float(os.getenv("FIXED_TP_PCT", "0.04"))
 
-ALLOWED_SYMBOLS = os.getenv("ALLOWED_SYMBOLS", "BTCUSDT,ETHUSDT,DOGEUSDT,SOLUSDT,BNBUSDT").split(",")
+# سقف ارسال هم‌زمان به تلگرام (محدودیت سراسری ~۳۰ پیام در ثانیه)
+TG_SEND_CONCURRENCY = int(os.getenv("TG_SEND_CONCURRENCY", "30"))
+# سقف حجم بدنه‌ی درخواست‌ها (قبل از parse و هر کار DB رد می‌شوند)
+MAX_BODY_BYTES = int(os.getenv("MAX_BODY_BYTES", "65536"))
+# سقف پیام در ثانیه برای ارسال‌های گروهی (کل سرویس، بین workerها تقسیم می‌شود)
+TG_BROADCAST_PER_SEC = int(os.getenv("TG_BROADCAST_PER_SEC", "30"))
+# تعداد worker‌های uvicorn؛ همان متغیری که python main.py و اکثر PaaSها استفاده می‌کنند
+WEB_CONCURRENCY = max(1, int(os.getenv("WEB_CONCURRENCY", "1")))
+
+ALLOWED_SYMBOLS = frozenset(
+    s.strip().upper()
+    for s in os.getenv("ALLOWED_SYMBOLS", "BTCUSDT,ETHUSDT,DOGEUSDT,SOLUSDT,BNBUSDT").split(",")
+    if s.strip()
+)
 
 # ─────────────────────────────────────────────────────────────
 # App
 # ─────────────────────────────────────────────────────────────
-app = FastAPI(title="SourceTrader")
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    global DB_EXECUTOR, POOL, TG_CLIENT
+    # executor، pool و مایگریشن هنگام startup (نه هنگام import)؛ مایگریشن با RUN_MIGRATIONS=false غیرفعال می‌شود
+    # (هر lifespan executor خودش را می‌سازد؛ lifespan دوم در همان پروسه به executor بسته‌شده نمی‌خورد)
+    DB_EXECUTOR = ThreadPoolExecutor(max_workers=DB_POOL_MAX, thread_name_prefix="db")
+    POOL = await run_db(_open_pool)
+    if RUN_MIGRATIONS:
+        await run_db(migrate_db)
+    TG_CLIENT = _open_tg_client()
+    # گرم کردن اتصال HTTP/2 به تلگرام (DNS + TLS) تا اولین سیگنال معطل نشود
+    prewarm = asyncio.create_task(_prewarm_tg())
+    yield
+    prewarm.cancel()
+    await TG_CLIENT.aclose()
+    DB_EXECUTOR.shutdown(wait=True)
+    POOL.closeall()
+
+app = FastAPI(title="SourceTrader", lifespan=lifespan, default_response_class=ORJSONResponse)
+
+@app.middleware("http")
+async def limit_body_size(request: Request, call_next):
+    size = request.headers.get("content-length")
+    if size is None:
+        # بدنه‌ی chunked طولش از قبل معلوم نیست و از این سقف رد می‌شد؛ Telegram و TradingView هر دو Content-Length می‌فرستند
+        if "transfer-encoding" in request.headers:
+            return JSONResponse({"detail": "length required"}, status_code=411)
+    elif not size.isdigit() or int(size) > MAX_BODY_BYTES:
+        return JSONResponse({"detail": "payload too large"}, status_code=413)
+    return await call_next(request)
+
+def secret_ok(given: str | None, expected: str) -> bool:
+    # مقایسه‌ی زمان-ثابت برای secret/token ها
+    return hmac.compare_digest((given or "").encode(), expected.encode())
 
 # ─────────────────────────────────────────────────────────────
 # DB Helpers
 # ─────────────────────────────────────────────────────────────
+class PreparingConnection(psycopg2.extensions.connection):
+    # نام statementهایی که روی همین session با PREPARE ساخته شده‌اند
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.prepared = set()
+
+def _open_pool():
+    return psycopg2.pool.ThreadedConnectionPool(
+        # DB_POOL_MIN بزرگ‌تر از DB_POOL_MAX، pool را در startup خراب می‌کرد
+        min(DB_POOL_MIN, DB_POOL_MAX),
+        DB_POOL_MAX,
+        dsn=DATABASE_URL,
+        connection_factory=PreparingConnection,
+        cursor_factory=psycopg2.extras.RealDictCursor,
+        # اتصال‌های بیکار pool نباید پشت NAT/load balancer بی‌صدا قطع شوند
+        keepalives=1,
+        keepalives_idle=30,
+        keepalives_interval=10,
+        keepalives_count=3,
+    )
+
+# در lifespan ساخته می‌شود
+POOL: psycopg2.pool.ThreadedConnectionPool | None = None
+# ThreadedConnectionPool وقتی پر باشد PoolError می‌دهد؛ با این semaphore منتظر می‌مانیم
+_POOL_SLOTS = threading.BoundedSemaphore(DB_POOL_MAX)
+
+@contextmanager
 def get_conn():
-    return psycopg2.connect(DATABASE_URL, cursor_factory=psycopg2.extras.RealDictCursor)
+    # اتصال از pool قرض گرفته و در پایان برگردانده می‌شود
+    _POOL_SLOTS.acquire()
+    try:
+        conn = POOL.getconn()
+    except Exception:
+        _POOL_SLOTS.release()
+        raise
+    try:
+        yield conn
+        conn.commit()
+    except Exception:
+        if not conn.closed:
+            conn.rollback()
+        raise
+    finally:
+        # اتصال قطع‌شده دوباره به pool برنمی‌گردد
+        try:
+            POOL.putconn(conn, close=bool(conn.closed))
+        finally:
+            _POOL_SLOTS.release()
 
-def db_exec(q, args=None):
+def db_exec(q, args=None, cursor_factory=None):
+    # cursor_factory=psycopg2.extensions.cursor برای ردیف‌های tuple (بدون ساخت dict برای هر ردیف)
     with get_conn() as conn:
-        with conn.cursor() as cur:
+        with conn.cursor(cursor_factory=cursor_factory) as cur:
             cur.execute(q, args or ())
             if cur.description:
                 return cur.fetchall()
             return None
 
-def migrate_db():
-    # users
-    db_exec(
-        """CREATE TABLE IF NOT EXISTS users(
-            id BIGINT PRIMARY KEY,
-            expires_at TIMESTAMPTZ,
-            awaiting_tx BOOLEAN DEFAULT FALSE,
-            trial_started_at TIMESTAMPTZ,
-            created_at TIMESTAMPTZ DEFAULT NOW()
-        )"""
-    )
-    # signals
-    db_exec(
-        """CREATE TABLE IF NOT EXISTS signals(
-            id SERIAL PRIMARY KEY,
-            symbol TEXT NOT NULL,
-            side TEXT NOT NULL,
-            price DOUBLE PRECISION NOT NULL,
-            time TIMESTAMPTZ NOT NULL,
-            created_at TIMESTAMPTZ DEFAULT NOW()
-        )"""
-    )
-    # migrations/additions
-    db_exec("ALTER TABLE signals ADD COLUMN IF NOT EXISTS ref_open_id INTEGER")
-    db_exec("ALTER TABLE signals ADD COLUMN IF NOT EXISTS pnl_pct DOUBLE PRECISION")
-    db_exec("ALTER TABLE signals ADD COLUMN IF NOT EXISTS closed_at TIMESTAMPTZ")
-    db_exec("CREATE INDEX IF NOT EXISTS idx_signals_time ON signals(time)")
-    db_exec("CREATE INDEX IF NOT EXISTS idx_signals_ref ON signals(ref_open_id)")
-    db_exec("CREATE INDEX IF NOT EXISTS idx_signals_side ON signals(side)")
-    db_exec("CREATE INDEX IF NOT EXISTS idx_users_expires ON users(expires_at)")
+def db_exec_prepared(stmt, args=(), cursor_factory=None):
+    # stmt = (name, param_types, sql با $1..$n) — یک‌بار PREPARE برای هر اتصال، سپس EXECUTE
+    name, types, sql = stmt
+    if not DB_PREPARE_STATEMENTS:
+        # $n → %(pn)s تا همان SQL بدون PREPARE اجرا شود
+        q = re.sub(r"\$(\d+)", r"%(p\1)s", sql)
+        return db_exec(q, {f"p{i}": v for i, v in enumerate(args, 1)}, cursor_factory)
+    with get_conn() as conn:
+        with conn.cursor(cursor_factory=cursor_factory) as cur:
+            if name not in conn.prepared:
+                cur.execute(f"PREPARE {name}({types}) AS {sql}" if types else f"PREPARE {name} AS {sql}")
+                conn.prepared.add(name)
+            if args:
+                cur.execute(f"EXECUTE {name}({', '.join(['%s'] * len(args))})", args)
+            else:
+                cur.execute(f"EXECUTE {name}")
+            if cur.description:
+                return cur.fetchall()
+            return None
+
+# psycopg2 بلاک‌کننده است؛ کارهای DB در threadهای جدا اجرا می‌شوند تا event loop آزاد بماند
+# (به اندازه‌ی pool، تا threadهای اضافه فقط پشت semaphore منتظر نمانند)
+# در lifespan ساخته می‌شود
+DB_EXECUTOR: ThreadPoolExecutor | None = None
 
-# Run migration on startup
-migrate_db()
+async def run_db(fn, *args):
+    return await asyncio.get_running_loop().run_in_executor(DB_EXECUTOR, fn, *args)
+
+MIGRATION_LOCK_ID = 918273
+# با هر تغییر در DDL زیر یک واحد بالا برود
+SCHEMA_VERSION = "2"
+
+def _schema_current(cur) -> bool:
+    # جدول meta در subquery هنگام parse resolve می‌شود؛ پس وجودش جدا بررسی می‌شود
+    cur.execute("SELECT to_regclass('meta') IS NOT NULL AS has_meta")
+    if not cur.fetchone()["has_meta"]:
+        return False
+    cur.execute("SELECT value FROM meta WHERE key='schema_version'")
+    row = cur.fetchone()
+    return bool(row) and row["value"] == SCHEMA_VERSION
+
+def migrate_db():
+    # کل DDL در یک تراکنش؛ workerهای دیگر پشت قفل منتظر می‌مانند تا جدول‌ها ساخته شوند
+    # (قفل xact با PgBouncer در حالت transaction هم سازگار است)
+    with get_conn() as conn:
+        with conn.cursor() as cur:
+            # شروع گرم: اسکیمای فعلی قبلاً اعمال شده، بدون قفل و DDL برگرد
+            if _schema_current(cur):
+                return True
+            cur.execute("SELECT pg_advisory_xact_lock(%s)", (MIGRATION_LOCK_ID,))
+            # worker دیگری در این فاصله مایگریشن را تمام کرده
+            if _schema_current(cur):
+                return True
+            cur.execute("CREATE TABLE IF NOT EXISTS meta(key TEXT PRIMARY KEY, value TEXT NOT NULL)")
+            # users
+            cur.execute(
+                """CREATE TABLE IF NOT EXISTS users(
+                    id BIGINT PRIMARY KEY,
+                    expires_at TIMESTAMPTZ,
+                    awaiting_tx BOOLEAN DEFAULT FALSE,
+                    trial_started_at TIMESTAMPTZ,
+                    created_at TIMESTAMPTZ DEFAULT NOW()
+                )"""
+            )
+            # signals
+            cur.execute(
+                """CREATE TABLE IF NOT EXISTS signals(
+                    id SERIAL PRIMARY KEY,
+                    symbol TEXT NOT NULL,
+                    side TEXT NOT NULL,
+                    price DOUBLE PRECISION NOT NULL,
+                    time TIMESTAMPTZ NOT NULL,
+                    created_at TIMESTAMPTZ DEFAULT NOW()
+                )"""
+            )
+            # migrations/additions
+            cur.execute("ALTER TABLE signals ADD COLUMN IF NOT EXISTS ref_open_id INTEGER")
+            cur.execute("ALTER TABLE signals ADD COLUMN IF NOT EXISTS pnl_pct DOUBLE PRECISION")
+            cur.execute("ALTER TABLE signals ADD COLUMN IF NOT EXISTS closed_at TIMESTAMPTZ")
+            # کاربرانی که ربات را بلاک کرده‌اند (403)؛ با پیام بعدی کاربر پاک می‌شود
+            cur.execute("ALTER TABLE users ADD COLUMN IF NOT EXISTS blocked_at TIMESTAMPTZ")
+            cur.execute("CREATE INDEX IF NOT EXISTS idx_signals_time ON signals(time)")
+            cur.execute("CREATE INDEX IF NOT EXISTS idx_signals_ref ON signals(ref_open_id)")
+            # ایندکس‌های partial مطابق شرط‌های آمار و ارسال
+            cur.execute(
+                "CREATE INDEX IF NOT EXISTS idx_signals_closed_pnl ON signals(closed_at) "
+                "WHERE pnl_pct IS NOT NULL AND side IN ('CLOSE_LONG', 'CLOSE_SHORT')"
+            )
+            cur.execute("CREATE INDEX IF NOT EXISTS idx_users_expires_active ON users(expires_at) WHERE expires_at IS NOT NULL")
+            cur.execute("DROP INDEX IF EXISTS idx_signals_side")
+            cur.execute("DROP INDEX IF EXISTS idx_users_expires")
+            # آمار روزانه‌ی کلوزها (روز تهران) — در /cron refresh می‌شود
+            cur.execute(
+                """CREATE MATERIALIZED VIEW IF NOT EXISTS signals_daily_stats AS
+                SELECT
+                  (closed_at AT TIME ZONE 'Asia/Tehran')::date         AS day,
+                  COUNT(*)                                             AS total,
+                  COUNT(*) FILTER (WHERE pnl_pct > 0)                  AS wins,
+                  COUNT(*) FILTER (WHERE pnl_pct <= 0)                 AS losses,
+                  COALESCE(SUM(pnl_pct) FILTER (WHERE pnl_pct > 0), 0) AS sum_profit_pos
+                FROM signals
+                WHERE (side='CLOSE_LONG' OR side='CLOSE_SHORT')
+                  AND pnl_pct IS NOT NULL
+                  AND closed_at IS NOT NULL
+                GROUP BY 1"""
+            )
+            cur.execute("CREATE UNIQUE INDEX IF NOT EXISTS idx_signals_daily_stats_day ON signals_daily_stats(day)")
+            # outbox: صف پیام‌های تلگرام (p=در انتظار، w=در حال ارسال، s=ارسال‌شده، f=ناموفق)
+            cur.execute(
+                """CREATE TABLE IF NOT EXISTS outbox(
+                    id BIGSERIAL PRIMARY KEY,
+                    chat_id BIGINT NOT NULL,
+                    text TEXT NOT NULL,
+                    parse_mode TEXT,
+                    reply_markup TEXT,
+                    status CHAR(1) NOT NULL DEFAULT 'p',
+                    attempts INTEGER NOT NULL DEFAULT 0,
+                    claimed_at TIMESTAMPTZ,
+                    created_at TIMESTAMPTZ DEFAULT NOW()
+                )"""
+            )
+            # ردیف ناموفق تا این زمان دوباره برداشته نمی‌شود (backoff بین تلاش‌ها)
+            cur.execute("ALTER TABLE outbox ADD COLUMN IF NOT EXISTS next_attempt_at TIMESTAMPTZ")
+            cur.execute("CREATE INDEX IF NOT EXISTS idx_outbox_pending ON outbox(id) WHERE status IN ('p', 'w')")
+            cur.execute(
+                "INSERT INTO meta(key, value) VALUES('schema_version', %s) "
+                "ON CONFLICT(key) DO UPDATE SET value=EXCLUDED.value",
+                (SCHEMA_VERSION,),
+            )
+            return True
 
 # ─────────────────────────────────────────────────────────────
 # Time & Jalali Helpers
 # ─────────────────────────────────────────────────────────────
-TZ_TEHRAN = pytz.timezone("Asia/Tehran")
+TZ_TEHRAN = ZoneInfo("Asia/Tehran")
 
 def now_dt() -> datetime:
     return datetime.now(timezone.utc)
 
 def to_tehran(dt: datetime) -> datetime:
-    if dt.tzinfo is None:
-        dt = dt.replace(tzinfo=timezone.utc)
+    # ورودی‌ها همیشه tz-aware هستند (TIMESTAMPTZ از DB، now_dt و زمان /tv)
     return dt.astimezone(TZ_TEHRAN)
 
+@lru_cache(maxsize=8192)
+def _g2j(y: int, m: int, d: int) -> tuple[int, int, int]:
+    # تبدیل تاریخ فقط به روز وابسته است؛ ردیف‌های هم‌روز از کش می‌آیند
+    return tuple(jdatetime.GregorianToJalali(y, m, d).getJalaliList())
+
 def jalali_date_str(dt: datetime) -> str:
     t = to_tehran(dt)
-    j = jdatetime.GregorianToJalali(t.year, t.month, t.day).getJalaliList()
-    y, m, d = j
-    hh = str(t.hour).zfill(2)
-    mm = str(t.minute).zfill(2)
-    return f"{y:04d}/{m:02d}/{d:02d} - {hh}:{mm}"
+    y, m, d = _g2j(t.year, t.month, t.day)
+    return f"{y:04d}/{m:02d}/{d:02d} - {t.hour:02d}:{t.minute:02d}"
 
 def jalali_short(dt: datetime) -> str:
     t = to_tehran(dt)
-    j = jdatetime.GregorianToJalali(t.year, t.month, t.day).getJalaliList()
-    y, m, d = j
+    y, m, d = _g2j(t.year, t.month, t.day)
     return f"{y:04d}/{m:02d}/{d:02d}"
 
 # ─────────────────────────────────────────────────────────────
@@ -126,18 +339,11 @@ def format_price(p: float) -> str:
     except:
         return str(p)
 
-    if p >= 100:
-        fmt = f"{p:.2f}"
-    elif p >= 1:
-        fmt = f"{p:.4f}"
-    elif p >= 0.1:
-        fmt = f"{p:.5f}"
-    else:
-        fmt = f"{p:.5f}"
+    # ≥100: دو رقم اعشار، ≥1: چهار رقم، کمتر: پنج رقم
+    fmt = f"{p:.2f}" if p >= 100 else f"{p:.4f}" if p >= 1 else f"{p:.5f}"
 
     # حذف صفرهای انتهایی و نقطه اضافه
-    fmt = fmt.rstrip("0").rstrip(".")
-    return fmt
+    return fmt.rstrip("0").rstrip(".")
 
 # ─────────────────────────────────────────────────────────────
 # Telegram helpers
@@ -173,52 +379,331 @@ RISK_NOTE = (
     "انتخاب نهایی، مدیریت سرمایه و تصمیم به نگه‌داشتن یا بستن معامله همیشه با شماست."
 )
 
-def tg_send(chat_id: int, text: str, parse_mode: str = "Markdown", reply_markup=None):
-    payload = {"chat_id": chat_id, "text": text, "parse_mode": parse_mode}
+# یک کلاینت مشترک (keep-alive + HTTP/2) برای همه‌ی درخواست‌های تلگرام
+# retry فقط در _tg_post انجام می‌شود (retry در transport هم تعداد تلاش‌ها را ضرب می‌کرد)
+def _open_tg_client():
+    return httpx.AsyncClient(
+        base_url=TG_API,
+        timeout=httpx.Timeout(10, connect=5),
+        transport=httpx.AsyncHTTPTransport(
+            http2=True,
+            limits=httpx.Limits(max_keepalive_connections=50, keepalive_expiry=60),
+        ),
+    )
+
+# در lifespan ساخته می‌شود (مثل POOL)
+TG_CLIENT: httpx.AsyncClient | None = None
+TG_SEND_SEM = asyncio.Semaphore(TG_SEND_CONCURRENCY)
+
+# کیبورد پیش‌فرض ثابت است؛ یک بار به JSON تبدیل می‌شود
+TG_KEYBOARD_DEFAULT_JSON = orjson.dumps(tg_keyboard_default()).decode()
+_TG_JSON_HEADERS = {"content-type": "application/json"}
+
+def _tg_body_tail(text: str, parse_mode: str, reply_markup) -> bytes:
+    # همه‌ی فیلدهای sendMessage به‌جز chat_id؛ reply_markup می‌تواند dict یا JSON آماده باشد
+    tail = b',"text":' + orjson.dumps(text)
+    if parse_mode:
+        tail += b',"parse_mode":' + orjson.dumps(parse_mode)
     if reply_markup:
-        payload["reply_markup"] = reply_markup
-    # Retry ساده
-    for i in range(3):
+        if isinstance(reply_markup, str):
+            tail += b',"reply_markup":' + reply_markup.encode()
+        else:
+            tail += b',"reply_markup":' + orjson.dumps(reply_markup)
+    return tail + b"}"
+
+# circuit breaker برای هر چت (فقط ارسال‌های outbox): بعد از چند خطای پشت‌سرهم، تا مدتی به آن چت ارسال نمی‌شود
+TG_BREAKER_FAILS = 3
+TG_BREAKER_COOLDOWN = 300
+# تلاش دوباره برای 429/5xx/خطای اتصال
+TG_SEND_RETRIES = 3
+TG_RETRY_MAX_DELAY = 30.0
+# sendMessage idempotent نیست: ReadTimeout و مشابه‌ها ممکن است بعد از قبول پیام رخ دهند
+_TG_RETRYABLE_ERRORS = (httpx.ConnectError, httpx.ConnectTimeout, httpx.PoolTimeout)
+_tg_fails: dict[int, tuple[int, float]] = {}
+# چت‌هایی که 403 داده‌اند (ربات بلاک شده)؛ بعد از هر دسته‌ی outbox در DB ثبت می‌شوند
+_tg_blocked: set[int] = set()
+
+def _prune_tg_fails():
+    # ورودی‌هایی که پنجره‌شان گذشته حذف می‌شوند تا dict بی‌حد رشد نکند
+    cutoff = time.monotonic() - TG_BREAKER_COOLDOWN
+    for chat_id in [c for c, (_, last) in _tg_fails.items() if last < cutoff]:
+        del _tg_fails[chat_id]
+
+async def _tg_post(chat_id: int | str, tail: bytes, breaker: bool = False):
+    # breaker=False برای پاسخ‌های تعاملی: جواب کاربر هیچ‌وقت بی‌صدا حذف نمی‌شود
+    fails, last = _tg_fails.get(chat_id, (0, 0.0)) if breaker else (0, 0.0)
+    if fails >= TG_BREAKER_FAILS and time.monotonic() - last < TG_BREAKER_COOLDOWN:
+        return None
+    body = (b'{"chat_id":%d' % chat_id if isinstance(chat_id, int) else b'{"chat_id":' + orjson.dumps(chat_id)) + tail
+    # 429: همان retry_after تلگرام صبر می‌شود؛ 5xx و خطای اتصال: backoff نمایی
+    for attempt in range(TG_SEND_RETRIES + 1):
+        delay = None
         try:
-            r = httpx.post(f"{TG_API}/sendMessage", json=payload, timeout=10)
+            async with TG_SEND_SEM:
+                r = await TG_CLIENT.post("/sendMessage", content=body, headers=_TG_JSON_HEADERS)
             if r.status_code == 200:
+                _tg_fails.pop(chat_id, None)
                 return r.json()
-        except Exception:
-            pass
+            # فقط کاربران (id عددی)؛ کانال (@name) در جدول users نیست
+            if r.status_code == 403 and isinstance(chat_id, int):
+                _tg_blocked.add(chat_id)
+            err = f"HTTP {r.status_code}: {r.text[:200]}"
+            if r.status_code == 429:
+                try:
+                    delay = float(r.json()["parameters"]["retry_after"])
+                except Exception:
+                    delay = 1.0
+            elif r.status_code >= 500:
+                delay = 0.5 * 2 ** attempt
+        except _TG_RETRYABLE_ERRORS as e:
+            # درخواست هنوز ارسال نشده؛ تکرار باعث پیام تکراری نمی‌شود
+            err = repr(e)
+            delay = 0.5 * 2 ** attempt
+        except Exception as e:
+            err = repr(e)
+        if delay is None or attempt == TG_SEND_RETRIES:
+            break
+        # خارج از semaphore صبر می‌کنیم تا بقیه‌ی ارسال‌ها معطل نمانند
+        await asyncio.sleep(min(delay, TG_RETRY_MAX_DELAY))
+    if breaker:
+        _tg_fails[chat_id] = (fails + 1, time.monotonic())
+    print("TG SEND ERROR:", chat_id, err)
     return None
 
+async def _prewarm_tg():
+    try:
+        await TG_CLIENT.get("/getMe")
+    except Exception:
+        pass
+
+async def tg_send(chat_id: int | str, text: str, parse_mode: str = "Markdown", reply_markup=None):
+    return await _tg_post(chat_id, _tg_body_tail(text, parse_mode, reply_markup))
+
 # ─────────────────────────────────────────────────────────────
-# Users & Subscription helpers
+# Outbox (صف ماندگار ارسال‌های گروهی)
 # ─────────────────────────────────────────────────────────────
-def get_user(uid: int):
-    rows = db_exec("SELECT * FROM users WHERE id=%s", (uid,))
-    return rows[0] if rows else None
+OUTBOX_BATCH = 500
+OUTBOX_MAX_ATTEMPTS = 3
+OUTBOX_KEEP_DAYS = 7
+# فاصله‌ی تلاش دوباره: ۳۰ ثانیه، بعد ۶۰ ثانیه (دو برابر در هر تلاش)
+OUTBOX_RETRY_BASE_SECONDS = 30
+
+def enqueue_broadcast(chat_ids, text: str, parse_mode: str = "Markdown", reply_markup=None) -> int:
+    # یک ردیف برای هر گیرنده، همه با یک INSERT
+    if not chat_ids:
+        return 0
+    with get_conn() as conn:
+        with conn.cursor() as cur:
+            cur.execute(
+                "INSERT INTO outbox(chat_id, text, parse_mode, reply_markup) "
+                "SELECT unnest(%s::bigint[]), %s, %s, %s",
+                (list(chat_ids), text, parse_mode, reply_markup),
+            )
+            return cur.rowcount
 
-def ensure_user(uid: int):
-    u = get_user(uid)
-    if not u:
-        db_exec("INSERT INTO users(id, awaiting_tx, trial_started_at) VALUES(%s, FALSE, NOW())", (uid,))
-    return get_user(uid)
+def claim_outbox(limit: int = OUTBOX_BATCH):
+    # ردیف‌های در انتظار (و ردیف‌های گیرکرده‌ی worker مرده) را برمی‌دارد؛ SKIP LOCKED برای چند worker
+    return db_exec(
+        """
+        UPDATE outbox SET status='w', attempts=attempts+1, claimed_at=NOW()
+        WHERE id IN (
+          SELECT id FROM outbox
+          WHERE (status='p' AND (next_attempt_at IS NULL OR next_attempt_at <= NOW()))
+             OR (status='w' AND claimed_at < NOW() - INTERVAL '5 minutes')
+          ORDER BY id
+          LIMIT %s
+          FOR UPDATE SKIP LOCKED
+        )
+        RETURNING id, chat_id, text, parse_mode, reply_markup
+        """,
+        (limit,),
+    ) or []
+
+def finish_outbox(sent_ids, failed_ids):
+    # ارسال‌شده‌ها s؛ ناموفق‌ها تا OUTBOX_MAX_ATTEMPTS دوباره p (با backoff) و بعد f
+    # بدون backoff همان drain ردیف را فوراً دوباره برمی‌داشت و در یک قطعی کوتاه همه‌ی تلاش‌ها می‌سوخت
+    with get_conn() as conn:
+        with conn.cursor() as cur:
+            if sent_ids:
+                cur.execute("UPDATE outbox SET status='s' WHERE id = ANY(%s)", (sent_ids,))
+            if failed_ids:
+                cur.execute(
+                    "UPDATE outbox SET status = CASE WHEN attempts >= %s THEN 'f' ELSE 'p' END, "
+                    "next_attempt_at = NOW() + make_interval(secs => %s * 2 ^ (attempts - 1)) "
+                    "WHERE id = ANY(%s)",
+                    (OUTBOX_MAX_ATTEMPTS, OUTBOX_RETRY_BASE_SECONDS, failed_ids),
+                )
+
+def mark_users_blocked(chat_ids):
+    # از لیست ارسال حذف می‌شوند تا broadcastهای بعدی کوچک‌تر شوند
+    db_exec("UPDATE users SET blocked_at=NOW() WHERE id = ANY(%s) AND blocked_at IS NULL", (list(chat_ids),))
+    invalidate_active_users()
+
+def prune_outbox(days: int = OUTBOX_KEEP_DAYS):
+    db_exec(
+        "DELETE FROM outbox WHERE status IN ('s', 'f') AND created_at < NOW() - make_interval(days => %s)",
+        (days,),
+    )
 
-def is_active_user(uid: int) -> bool:
-    row = db_exec("SELECT expires_at FROM users WHERE id=%s", (uid,))
-    if not row:
-        return False
-    exp = row[0]["expires_at"]
+# فقط یک drain در هر لحظه (در این پروسه) دسته برمی‌دارد و می‌فرستد
+# (claim هم داخل قفل است؛ ردیف claim‌شده نباید پشت قفل بماند تا reclaim پنج‌دقیقه‌ای دوباره بفرستدش)
+_TG_PACE_LOCK = asyncio.Lock()
+# قفل فقط داخل یک پروسه کار می‌کند؛ هر worker سهم خودش از سقف کل را مصرف می‌کند
+_TG_PACE_PER_SEC = max(1, TG_BROADCAST_PER_SEC // WEB_CONCURRENCY)
+
+async def _send_paced(rows, tails):
+    # دسته‌های _TG_PACE_PER_SEC تایی، هر دسته حداقل یک ثانیه (فراخواننده _TG_PACE_LOCK را دارد)
+    results = []
+    for i in range(0, len(rows), _TG_PACE_PER_SEC):
+        started = time.monotonic()
+        chunk = rows[i:i + _TG_PACE_PER_SEC]
+        results += await asyncio.gather(
+            *(
+                _tg_post(r["chat_id"], tails[(r["text"], r["parse_mode"], r["reply_markup"])], breaker=True)
+                for r in chunk
+            ),
+            return_exceptions=True,
+        )
+        if i + _TG_PACE_PER_SEC < len(rows):
+            await asyncio.sleep(max(0.0, 1.0 - (time.monotonic() - started)))
+    return results
+
+async def drain_outbox():
+    # دسته‌دسته برمی‌دارد و با سرعت محدود می‌فرستد
+    total = 0
+    while True:
+        async with _TG_PACE_LOCK:
+            rows = await run_db(claim_outbox)
+            if not rows:
+                return total
+            # متن‌های یکسان (یک broadcast) فقط یک بار serialize می‌شوند
+            tails = {}
+            for r in rows:
+                key = (r["text"], r["parse_mode"], r["reply_markup"])
+                if key not in tails:
+                    tails[key] = _tg_body_tail(*key)
+            results = await _send_paced(rows, tails)
+        sent, failed = [], []
+        for r, res in zip(rows, results):
+            (sent if res and not isinstance(res, BaseException) else failed).append(r["id"])
+        await run_db(finish_outbox, sent, failed)
+        if _tg_blocked:
+            blocked = list(_tg_blocked)
+            _tg_blocked.clear()
+            await run_db(mark_users_blocked, blocked)
+        _prune_tg_fails()
+        total += len(sent)
+        if len(rows) < OUTBOX_BATCH:
+            return total
+
+# ─────────────────────────────────────────────────────────────
+# Users & Subscription helpers
+# ─────────────────────────────────────────────────────────────
+_USER_COLS = "id, expires_at, awaiting_tx, trial_started_at"
+
+SQL_UPSERT_USER = (
+    "upsert_user",
+    "bigint",
+    f"""
+    WITH ins AS (
+      INSERT INTO users(id, awaiting_tx, trial_started_at) VALUES($1, FALSE, NOW())
+      ON CONFLICT(id) DO UPDATE SET blocked_at = NULL
+        WHERE users.blocked_at IS NOT NULL
+      RETURNING {_USER_COLS}
+    )
+    SELECT {_USER_COLS}, TRUE AS changed FROM ins
+    UNION ALL
+    SELECT {_USER_COLS}, FALSE FROM users WHERE id=$1 AND NOT EXISTS (SELECT 1 FROM ins)
+    """,
+)
+
+def _user_row(rows, uid: int):
+    # دو پیام اولِ هم‌زمان از یک کاربر: INSERT دیگری برنده می‌شود و ردیفش در snapshot همین
+    # statement دیده نمی‌شود، پس CTE هیچ ردیفی برنمی‌گرداند؛ یک SELECT جدا آن را می‌بیند
+    if rows:
+        return rows[0]
+    return db_exec(f"SELECT {_USER_COLS}, FALSE AS changed FROM users WHERE id=%s", (uid,))[0]
+
+def upsert_and_get_user(uid: int):
+    # ایجاد کاربر در صورت نبود + خواندن ردیف، در یک رفت‌وبرگشت
+    # (کاربر موجود فقط وقتی UPDATE می‌شود که قبلاً ربات را بلاک کرده بوده)
+    # پرتکرارترین کوئری است (هر پیام تلگرام)؛ مثل insert_signal یک‌بار PREPARE می‌شود
+    u = _user_row(db_exec_prepared(SQL_UPSERT_USER, (uid,)), uid)
+    if u["changed"] and u["expires_at"]:
+        invalidate_active_users()
+    return u
+
+def is_active(u) -> bool:
+    exp = u.get("expires_at") if u else None
     if not exp:
         return False
     return now_dt() <= exp
 
-def activate_trial(uid: int, days: int = TRIAL_DAYS):
-    # اگر قبلاً trial_started_at دارد و expires_at هم دارد، دوباره ست نکن
-    u = ensure_user(uid)
-    if u and u.get("trial_started_at") and u.get("expires_at"):
-        return
-    exp = now_dt() + timedelta(days=days)
-    db_exec(
-        "UPDATE users SET expires_at=%s, trial_started_at=COALESCE(trial_started_at, NOW()) WHERE id=%s",
-        (exp, uid),
+SQL_START_USER = (
+    "start_user",
+    "bigint, integer",
+    f"""
+    WITH up AS (
+      INSERT INTO users(id, awaiting_tx, trial_started_at, expires_at)
+      VALUES($1, FALSE, NOW(), NOW() + make_interval(days => $2))
+      ON CONFLICT(id) DO UPDATE
+        SET expires_at = CASE WHEN users.trial_started_at IS NULL OR users.expires_at IS NULL
+                              THEN EXCLUDED.expires_at ELSE users.expires_at END,
+            trial_started_at = COALESCE(users.trial_started_at, NOW()),
+            blocked_at = NULL
+        WHERE users.trial_started_at IS NULL OR users.expires_at IS NULL OR users.blocked_at IS NOT NULL
+      RETURNING {_USER_COLS}
+    )
+    SELECT {_USER_COLS}, TRUE AS changed FROM up
+    UNION ALL
+    SELECT {_USER_COLS}, FALSE FROM users WHERE id=$1 AND NOT EXISTS (SELECT 1 FROM up)
+    """,
+)
+
+def start_user(uid: int, days: int = TRIAL_DAYS):
+    # /start: ایجاد کاربر + فعال‌سازی تست (اگر قبلاً نداشته) + خواندن ردیف، در یک رفت‌وبرگشت
+    # اگر قبلاً trial_started_at دارد و expires_at هم دارد، دوباره ست نکن (فقط blocked_at پاک می‌شود)
+    u = _user_row(db_exec_prepared(SQL_START_USER, (uid, days)), uid)
+    if u["changed"]:
+        invalidate_active_users()
+    return u
+
+def confirm_subscription(uid: int, days: int = 30):
+    # خروج از حالت انتظار TX + تمدید از انقضای فعلی (یا از الان) در یک UPDATE
+    rows = db_exec(
+        "UPDATE users SET awaiting_tx=FALSE, "
+        "expires_at=GREATEST(COALESCE(expires_at, NOW()), NOW()) + make_interval(days => %s) "
+        "WHERE id=%s AND awaiting_tx "
+        "RETURNING expires_at",
+        (days, uid),
     )
+    if not rows:
+        return None
+    invalidate_active_users()
+    return rows[0]["expires_at"]
+
+SQL_ACTIVE_USER_IDS = (
+    "active_user_ids",
+    "",
+    "SELECT id FROM users WHERE expires_at >= NOW() AND blocked_at IS NULL",
+)
+
+# کش لیست کاربران فعال (timestamp, ids) — با تغییر اشتراک باطل می‌شود
+_active_users_cache: tuple[float, list[int]] = (float("-inf"), [])
+
+def active_user_ids() -> list[int]:
+    global _active_users_cache
+    ts, ids = _active_users_cache
+    if time.monotonic() - ts < ACTIVE_USERS_TTL:
+        return ids
+    rows = db_exec_prepared(SQL_ACTIVE_USER_IDS, cursor_factory=psycopg2.extensions.cursor)
+    ids = [r[0] for r in rows or []]
+    _active_users_cache = (time.monotonic(), ids)
+    return ids
+
+def invalidate_active_users():
+    global _active_users_cache
+    _active_users_cache = (float("-inf"), [])
 
 def set_awaiting_tx(uid: int, val: bool):
     db_exec("UPDATE users SET awaiting_tx=%s WHERE id=%s", (val, uid))
@@ -226,106 +711,165 @@ def set_awaiting_tx(uid: int, val: bool):
 # ─────────────────────────────────────────────────────────────
 # Signals helpers
 # ─────────────────────────────────────────────────────────────
-def insert_signal(symbol: str, side: str, price: float, t: datetime) -> int:
-    rows = db_exec(
-        "INSERT INTO signals(symbol, side, price, time) VALUES(%s,%s,%s,%s) RETURNING id",
-        (symbol, side, price, t),
-    )
-    return rows[0]["id"]
-
-def update_signal_ref(sid: int, ref_open_id: int):
-    db_exec("UPDATE signals SET ref_open_id=%s WHERE id=%s", (ref_open_id, sid))
+SQL_INSERT_SIGNAL = (
+    "insert_signal",
+    "text, text, double precision, timestamptz, integer",
+    """
+    INSERT INTO signals(symbol, side, price, time, ref_open_id, closed_at, pnl_pct)
+    SELECT $1, $2, $3, $4, $5,
+           CASE WHEN $2 IN ('CLOSE_LONG', 'CLOSE_SHORT') THEN NOW() END,
+           CASE WHEN o.price > 0 THEN ROUND((
+             CASE $2
+               WHEN 'CLOSE_LONG'  THEN ($3 - o.price) / o.price * 100
+               WHEN 'CLOSE_SHORT' THEN (o.price - $3) / o.price * 100
+             END)::numeric, 4)
+           END
+    FROM (SELECT 1) AS one
+    LEFT JOIN signals o ON o.id = $5
+    RETURNING id
+    """,
+)
 
-def set_signal_closed(close_id: int):
-    db_exec("UPDATE signals SET closed_at=NOW() WHERE id=%s", (close_id,))
+def insert_signal(symbol: str, side: str, price: float, t: datetime, ref_open_id: int | None = None) -> int:
+    # ثبت سیگنال + ref + closed_at + pnl (برای CLOSE_*) در یک رفت‌وبرگشت
+    rows = db_exec_prepared(SQL_INSERT_SIGNAL, (symbol, side, price, t, ref_open_id))
+    invalidate_last_signals()
+    return rows[0]["id"]
 
-def _calc_pnl_pct_for_close(close_row):
-    if not close_row or not close_row.get("ref_open_id"):
-        return None
-    op = db_exec("SELECT id, side, price FROM signals WHERE id=%s", (close_row["ref_open_id"],))
-    if not op:
-        return None
-    open_price = float(op[0]["price"])
-    close_price = float(close_row["price"])
-    side = close_row["side"].upper()
-    if open_price <= 0:
-        return None
-    if side == "CLOSE_LONG":
-        pnl = (close_price - open_price) / open_price * 100.0
-    elif side == "CLOSE_SHORT":
-        pnl = (open_price - close_price) / open_price * 100.0
-    else:
-        return None
-    return round(pnl, 4)
+_SQL_INSERT_SIGNALS_BATCH = """
+    INSERT INTO signals(symbol, side, price, time, ref_open_id, closed_at, pnl_pct)
+    SELECT v.symbol, v.side, v.price, v.time, v.ref,
+           CASE WHEN v.side IN ('CLOSE_LONG', 'CLOSE_SHORT') THEN NOW() END,
+           CASE WHEN o.price > 0 THEN ROUND((
+             CASE v.side
+               WHEN 'CLOSE_LONG'  THEN (v.price - o.price) / o.price * 100
+               WHEN 'CLOSE_SHORT' THEN (o.price - v.price) / o.price * 100
+             END)::numeric, 4)
+           END
+    FROM (VALUES %s) AS v(ord, symbol, side, price, time, ref)
+    LEFT JOIN signals o ON o.id = v.ref
+    ORDER BY v.ord
+    RETURNING id
+"""
+
+def insert_signals(items) -> list[int]:
+    # items = [(symbol, side, price, t, ref_open_id), ...] — همه در یک INSERT
+    # (کلوزی که به اوپنِ همین دسته ارجاع دارد pnl را بعداً از backfill می‌گیرد)
+    with get_conn() as conn:
+        with conn.cursor() as cur:
+            rows = psycopg2.extras.execute_values(
+                cur,
+                _SQL_INSERT_SIGNALS_BATCH,
+                [(i, *it) for i, it in enumerate(items)],
+                template="(%s, %s, %s, %s::double precision, %s::timestamptz, %s::integer)",
+                page_size=max(len(items), 1),
+                fetch=True,
+            )
+    invalidate_last_signals()
+    return [r["id"] for r in rows]
 
 def backfill_missing_pnl():
-    rows = db_exec(
-        """
-        SELECT id, side, price, ref_open_id
-        FROM signals
-        WHERE (side='CLOSE_LONG' OR side='CLOSE_SHORT')
-          AND pnl_pct IS NULL
-          AND ref_open_id IS NOT NULL
-        """
-    )
-    updated = 0
-    if not rows:
-        return 0
-    for r in rows:
-        pnl = _calc_pnl_pct_for_close(r)
-        if pnl is not None:
-            db_exec("UPDATE signals SET pnl_pct=%s WHERE id=%s", (pnl, r["id"]))
-            updated += 1
-    return updated
+    # محاسبه‌ی pnl همه‌ی کلوزهای بدون pnl با یک UPDATE ... FROM (به‌جای N+1 کوئری)
+    with get_conn() as conn:
+        with conn.cursor() as cur:
+            cur.execute(
+                """
+                UPDATE signals c
+                SET pnl_pct = ROUND((CASE c.side
+                  WHEN 'CLOSE_LONG'  THEN (c.price - o.price) / o.price * 100
+                  WHEN 'CLOSE_SHORT' THEN (o.price - c.price) / o.price * 100
+                END)::numeric, 4)
+                FROM signals o
+                WHERE o.id = c.ref_open_id
+                  AND c.pnl_pct IS NULL
+                  AND c.side IN ('CLOSE_LONG', 'CLOSE_SHORT')
+                  AND o.price > 0
+                """
+            )
+            return cur.rowcount
 
 # ─────────────────────────────────────────────────────────────
 # Stats helpers
 # ─────────────────────────────────────────────────────────────
-def _stats_since_days(days: int):
-    days = max(1, min(int(days), 90))
+# «امروز» بر اساس روز تقویمی تهران
+_SQL_TEHRAN_TODAY = "(NOW() AT TIME ZONE 'Asia/Tehran')::date"
+
+def _stats_for_windows(windows=(1, 7, 30)):
+    # روزهای گذشته از signals_daily_stats و فقط امروز از جدول signals خوانده می‌شود
+    windows = sorted({max(1, min(int(d), 90)) for d in windows})
+    today = _SQL_TEHRAN_TODAY
+    cols = []
+    for d in windows:
+        w = f"day > {today} - {d}"
+        cols.append(
+            f"""
+      COALESCE(SUM(total) FILTER (WHERE {w}), 0)          AS total_{d},
+      COALESCE(SUM(wins) FILTER (WHERE {w}), 0)           AS wins_{d},
+      COALESCE(SUM(losses) FILTER (WHERE {w}), 0)         AS losses_{d},
+      COALESCE(SUM(sum_profit_pos) FILTER (WHERE {w}), 0) AS sum_profit_pos_{d}"""
+        )
     q = f"""
-    WITH c AS (
-      SELECT pnl_pct
+    WITH d AS (
+      SELECT day, total, wins, losses, sum_profit_pos
+      FROM signals_daily_stats
+      WHERE day > {today} - {windows[-1]} AND day < {today}
+      UNION ALL
+      SELECT
+        {today},
+        COUNT(*),
+        COUNT(*) FILTER (WHERE pnl_pct > 0),
+        COUNT(*) FILTER (WHERE pnl_pct <= 0),
+        COALESCE(SUM(pnl_pct) FILTER (WHERE pnl_pct > 0), 0)
       FROM signals
       WHERE (side='CLOSE_LONG' OR side='CLOSE_SHORT')
         AND pnl_pct IS NOT NULL
-        AND closed_at >= NOW() - INTERVAL '{days} days'
+        AND closed_at >= {today}::timestamp AT TIME ZONE 'Asia/Tehran'
     )
-    SELECT
-      COUNT(*)                                         AS total,
-      COUNT(*) FILTER (WHERE pnl_pct > 0)              AS wins,
-      COUNT(*) FILTER (WHERE pnl_pct <= 0)             AS losses,
-      COALESCE(AVG(CASE WHEN pnl_pct > 0 THEN 1.0 ELSE 0.0 END) * 100, 0) AS winrate,
-      COALESCE(SUM(CASE WHEN pnl_pct > 0 THEN pnl_pct ELSE 0 END), 0)     AS sum_profit_pos
-    FROM c;
+    SELECT{",".join(cols)}
+    FROM d;
     """
     rows = db_exec(q)
-    if not rows:
-        return {"total": 0, "wins": 0, "losses": 0, "winrate": 0.0, "sum_profit_pos": 0.0}
-    r = rows[0]
-    return {
-        "total": int(r["total"] or 0),
-        "wins": int(r["wins"] or 0),
-        "losses": int(r["losses"] or 0),
-        "winrate": round(float(r["winrate"] or 0.0), 1),
-        "sum_profit_pos": round(float(r["sum_profit_pos"] or 0.0), 2),
-    }
+    r = rows[0] if rows else {}
+    out = {}
+    for d in windows:
+        total = int(r.get(f"total_{d}") or 0)
+        wins = int(r.get(f"wins_{d}") or 0)
+        out[d] = {
+            "total": total,
+            "wins": wins,
+            "losses": int(r.get(f"losses_{d}") or 0),
+            "winrate": round(wins / total * 100, 1) if total else 0.0,
+            "sum_profit_pos": round(float(r.get(f"sum_profit_pos_{d}") or 0.0), 2),
+        }
+    return out
+
+# آخرین روزی (تهران) که نمای آمار روزانه برایش refresh شده
+_daily_stats_refreshed_on = None
+
+def refresh_daily_stats(force: bool = False):
+    # روزهای بسته‌شده تغییر نمی‌کنند؛ فقط با عوض شدن روز یا بک‌فیل جدید refresh لازم است
+    global _daily_stats_refreshed_on
+    today = to_tehran(now_dt()).date()
+    if not force and _daily_stats_refreshed_on == today:
+        return False
+    db_exec("REFRESH MATERIALIZED VIEW CONCURRENTLY signals_daily_stats")
+    _daily_stats_refreshed_on = today
+    return True
+
+# فقط ۱۱ حالت ممکن است؛ یک‌بار ساخته می‌شوند
+_BARS = tuple("█" * i + "░" * (10 - i) for i in range(11))
 
 def _bar(winrate: float) -> str:
-    winrate = max(0.0, min(100.0, winrate))
-    blocks = 10
-    filled = int(round(winrate / 10.0))
-    return "█" * filled + "░" * (blocks - filled)
+    return _BARS[max(0, min(10, int(round(winrate / 10.0))))]
 
 def format_stats_message():
     try:
-        backfill_missing_pnl()
+        refresh_daily_stats(bool(backfill_missing_pnl()))
     except Exception:
         pass
 
-    d1 = _stats_since_days(1)
-    d7 = _stats_since_days(7)
-    d30 = _stats_since_days(30)
+    stats = _stats_for_windows((1, 7, 30))
+    d1, d7, d30 = stats[1], stats[7], stats[30]
 
     def block(title, d):
         return (
@@ -349,17 +893,24 @@ def format_stats_message():
 # ─────────────────────────────────────────────────────────────
 # Message builders (سیگنال‌ها)
 # ─────────────────────────────────────────────────────────────
+_SIDE_FA = {
+    "LONG": "Long",
+    "SHORT": "Short",
+    "CLOSE_LONG": "Close Long",
+    "CLOSE_SHORT": "Close Short",
+}
+# فقط همین جهت‌ها ثبت و ارسال می‌شوند (متن آزاد می‌تواند Markdown پیام را خراب کند)
+VALID_SIDES = frozenset(_SIDE_FA)
+
 def side_fa(side_en: str) -> str:
     s = side_en.upper()
-    if s == "LONG":
-        return "Long"
-    if s == "SHORT":
-        return "Short"
-    if s == "CLOSE_LONG":
-        return "Close Long"
-    if s == "CLOSE_SHORT":
-        return "Close Short"
-    return s
+    return _SIDE_FA.get(s, s)
+
+# ضریب‌های (حد ضرر، تارگت) برای هر جهت؛ درصدها در طول عمر پروسه ثابت‌اند
+_SLTP_MULT = {
+    "LONG": (1 - FIXED_SL_PCT, 1 + FIXED_TP_PCT),
+    "SHORT": (1 + FIXED_SL_PCT, 1 - FIXED_TP_PCT),
+}
 
 def format_signal_message(symbol: str, side: str, price: float, t: datetime, with_sltp=True):
     dt_str = jalali_date_str(t)
@@ -375,13 +926,10 @@ def format_signal_message(symbol: str, side: str, price: float, t: datetime, wit
         f"زمان: `{dt_str}`\n"
     )
 
-    if with_sltp and SHOW_FIXED_SLTP and side.upper() in ("LONG", "SHORT"):
-        if side.upper() == "LONG":
-            sl = price * (1 - FIXED_SL_PCT)
-            tp = price * (1 + FIXED_TP_PCT)
-        else:
-            sl = price * (1 + FIXED_SL_PCT)
-            tp = price * (1 - FIXED_TP_PCT)
+    mult = _SLTP_MULT.get(side.upper()) if with_sltp and SHOW_FIXED_SLTP else None
+    if mult:
+        sl = price * mult[0]
+        tp = price * mult[1]
         msg += f"\nحد ضرر: `{format_price(sl)}`\n"
         msg += f"تارگت: `{format_price(tp)}`\n"
 
@@ -415,195 +963,308 @@ def health_head():
 # ─────────────────────────────────────────────────────────────
 # Routes: Telegram Webhook
 # ─────────────────────────────────────────────────────────────
-@app.post("/tg/webhook")
-async def tg_webhook(request: Request, x_telegram_bot_api_secret_token: str | None = Header(default=None)):
-    # Optional: telegram secret token check
-    if TG_WEBHOOK_SECRET and x_telegram_bot_api_secret_token != TG_WEBHOOK_SECRET:
-        return JSONResponse({"detail": "forbidden"}, status_code=403)
+# هر handler ورودی (chat_id, user_id, text, u) دارد؛ u ردیف کاربر همین درخواست است
+async def handle_help(chat_id, user_id, text, u):
+    await tg_send(chat_id, HELP_TEXT, reply_markup=TG_KEYBOARD_DEFAULT_JSON)
 
-    data = await request.json()
-    msg = data.get("message") or data.get("edited_message")
-    if not msg:
-        return {"ok": True}
+async def handle_support(chat_id, user_id, text, u):
+    await tg_send(chat_id, "برای پشتیبانی و سوالات: @sourcetrader_support", reply_markup=TG_KEYBOARD_DEFAULT_JSON)
 
-    chat = msg.get("chat", {})
-    chat_id = chat.get("id")
-    user_id = msg.get("from", {}).get("id")
-    text = (msg.get("text") or "").strip()
-
-    # Ensure user exists
-    ensure_user(user_id)
+async def handle_stats(chat_id, user_id, text, u):
+    try:
+        msg_stats = await run_db(format_stats_message)
+    except Exception:
+        msg_stats = "❗️ خطا در محاسبه‌ی آمار. بعداً دوباره تلاش کنید."
+    await tg_send(chat_id, msg_stats, reply_markup=TG_KEYBOARD_DEFAULT_JSON)
 
-    # Map Persian buttons to commands
-    txt = text
-    if txt in ("ℹ️ راهنما", "/help"):
-        tg_send(chat_id, HELP_TEXT, reply_markup=tg_keyboard_default())
-        return {"ok": True}
+SQL_LAST_SIGNALS = (
+    "last_signals",
+    "",
+    "SELECT symbol, side, price, time FROM signals ORDER BY id DESC LIMIT 5",
+)
 
-    if txt in ("🆘 پشتیبانی",):
-        tg_send(chat_id, "برای پشتیبانی و سوالات: @sourcetrader_support", reply_markup=tg_keyboard_default())
-        return {"ok": True}
+# متن آماده‌ی /last (timestamp, text) — با ثبت سیگنال در همین پروسه باطل می‌شود؛
+# TTL برای سیگنال‌هایی که worker دیگری ثبت کرده
+_last_signals_cache: tuple[float, str | None] = (float("-inf"), None)
 
-    if txt in ("📊 آمار", "/stats"):
-        try:
-            msg_stats = format_stats_message()
-        except Exception:
-            msg_stats = "❗️ خطا در محاسبه‌ی آمار. بعداً دوباره تلاش کنید."
-        tg_send(chat_id, msg_stats, reply_markup=tg_keyboard_default())
-        return {"ok": True}
-
-    if txt in ("🧾 آخرین سیگنال‌ها", "/last"):
-        rows = db_exec("SELECT symbol, side, price, time FROM signals ORDER BY id DESC LIMIT 5")
-        if not rows:
-            tg_send(chat_id, "فعلاً سیگنالی ثبت نشده.", reply_markup=tg_keyboard_default())
-            return {"ok": True}
+def last_signals_message() -> str:
+    global _last_signals_cache
+    ts, msg = _last_signals_cache
+    if msg is not None and time.monotonic() - ts < LAST_SIGNALS_TTL:
+        return msg
+    rows = db_exec_prepared(SQL_LAST_SIGNALS)
+    if not rows:
+        msg = "فعلاً سیگنالی ثبت نشده."
+    else:
         lines = ["🧾 آخرین سیگنال‌ها:"]
         for r in rows:
             lines.append(
                 f"- {r['symbol']} | {side_fa(r['side'])} | {format_price(r['price'])} | {jalali_date_str(r['time'])}"
             )
-        tg_send(chat_id, "\n".join(lines), reply_markup=tg_keyboard_default())
-        return {"ok": True}
+        msg = "\n".join(lines)
+    _last_signals_cache = (time.monotonic(), msg)
+    return msg
 
-    if txt in ("📥 اشتراک", "/subscribe"):
-        set_awaiting_tx(user_id, True)
-        tg_send(
-            chat_id,
-            "برای فعال‌سازی اشتراک، هش/لینک تراکنش کریپتو را همینجا ارسال کنید.\n"
-            "پس از بررسی، اشتراک شما فعال می‌شود.",
-            reply_markup=tg_keyboard_default(),
-        )
-        return {"ok": True}
+def invalidate_last_signals():
+    global _last_signals_cache
+    _last_signals_cache = (float("-inf"), None)
+
+async def handle_last(chat_id, user_id, text, u):
+    msg = await run_db(last_signals_message)
+    await tg_send(chat_id, msg, reply_markup=TG_KEYBOARD_DEFAULT_JSON)
+
+async def handle_subscribe(chat_id, user_id, text, u):
+    await run_db(set_awaiting_tx, user_id, True)
+    await tg_send(
+        chat_id,
+        "برای فعال‌سازی اشتراک، هش/لینک تراکنش کریپتو را همینجا ارسال کنید.\n"
+        "پس از بررسی، اشتراک شما فعال می‌شود.",
+        reply_markup=TG_KEYBOARD_DEFAULT_JSON,
+    )
 
-    if txt == "/start":
-        # فعال‌سازی تست اگر قبلاً نداشته
-        activate_trial(user_id, TRIAL_DAYS)
-        u = get_user(user_id)
-        exp = u.get("expires_at")
-        active = "✅ فعال" if is_active_user(user_id) else "⛔️ غیرفعال"
-        exp_str = jalali_short(exp) if exp else "—"
-        tg_send(
-            chat_id,
-            f"خوش آمدید 👋\nوضعیت اشتراک: {active}\nتاریخ انقضا: {exp_str}",
-            reply_markup=tg_keyboard_default(),
-        )
-        return {"ok": True}
+async def handle_start(chat_id, user_id, text, u):
+    # u از start_user می‌آید (تست در همان کوئری فعال شده)
+    exp = u.get("expires_at")
+    active = "✅ فعال" if is_active(u) else "⛔️ غیرفعال"
+    exp_str = jalali_short(exp) if exp else "—"
+    await tg_send(
+        chat_id,
+        f"خوش آمدید 👋\nوضعیت اشتراک: {active}\nتاریخ انقضا: {exp_str}",
+        reply_markup=TG_KEYBOARD_DEFAULT_JSON,
+    )
+
+async def handle_status(chat_id, user_id, text, u):
+    exp = u.get("expires_at")
+    active = "✅ فعال" if is_active(u) else "⛔️ غیرفعال"
+    exp_str = jalali_short(exp) if exp else "—"
+    await tg_send(chat_id, f"وضعیت اشتراک: {active}\nتاریخ انقضا: {exp_str}", reply_markup=TG_KEYBOARD_DEFAULT_JSON)
 
+async def handle_default(chat_id, user_id, text, u):
     # اگر در حالت انتظار TX هست:
-    u = get_user(user_id)
-    if u and u.get("awaiting_tx"):
+    if u.get("awaiting_tx"):
         # هر متنی را به عنوان TXID می‌پذیریم و اشتراک را ۳۰ روز تمدید می‌کنیم
-        db_exec("UPDATE users SET awaiting_tx=FALSE WHERE id=%s", (user_id,))
-        new_exp = now_dt() + timedelta(days=30)
-        db_exec("UPDATE users SET expires_at=%s WHERE id=%s", (new_exp, user_id))
-        tg_send(
-            chat_id,
-            f"✅ پرداخت دریافت شد و اشتراک تا {jalali_short(new_exp)} فعال شد.",
-            reply_markup=tg_keyboard_default(),
-        )
-        return {"ok": True}
+        new_exp = await run_db(confirm_subscription, user_id, 30)
+        if new_exp:
+            await tg_send(
+                chat_id,
+                f"✅ پرداخت دریافت شد و اشتراک تا {jalali_short(new_exp)} فعال شد.",
+                reply_markup=TG_KEYBOARD_DEFAULT_JSON,
+            )
+            return
+
+    # پیش‌فرض: راهنما
+    await tg_send(chat_id, HELP_TEXT, reply_markup=TG_KEYBOARD_DEFAULT_JSON)
+
+# Map Persian buttons to commands
+HANDLERS = {
+    "ℹ️ راهنما": handle_help,
+    "/help": handle_help,
+    "🆘 پشتیبانی": handle_support,
+    "📊 آمار": handle_stats,
+    "/stats": handle_stats,
+    "🧾 آخرین سیگنال‌ها": handle_last,
+    "/last": handle_last,
+    "📥 اشتراک": handle_subscribe,
+    "/subscribe": handle_subscribe,
+    "/start": handle_start,
+    "/status": handle_status,
+}
+
+def _route(text: str):
+    # دکمه‌ها متن کامل‌اند (با فاصله)؛ دستورها با اولین توکن، بدون @botname
+    # (مثلاً "/start ref123" یا "/stats@SourceTraderBot" در گروه)
+    handler = HANDLERS.get(text)
+    if handler is None and text.startswith("/"):
+        handler = HANDLERS.get(text.split(maxsplit=1)[0].partition("@")[0])
+    return handler or handle_default
 
-    # اندازه‌گیری وضعیت
-    if txt == "/status":
-        u = get_user(user_id)
-        exp = u.get("expires_at")
-        active = "✅ فعال" if is_active_user(user_id) else "⛔️ غیرفعال"
-        exp_str = jalali_short(exp) if exp else "—"
-        tg_send(chat_id, f"وضعیت اشتراک: {active}\nتاریخ انقضا: {exp_str}", reply_markup=tg_keyboard_default())
+@app.post("/tg/webhook")
+async def tg_webhook(request: Request, x_telegram_bot_api_secret_token: str | None = Header(default=None)):
+    # Optional: telegram secret token check
+    if TG_WEBHOOK_SECRET and not secret_ok(x_telegram_bot_api_secret_token, TG_WEBHOOK_SECRET):
+        return JSONResponse({"detail": "forbidden"}, status_code=403)
+
+    data = orjson.loads(await request.body())
+    msg = data.get("message") or data.get("edited_message")
+    if not msg:
         return {"ok": True}
 
-    # پیش‌فرض: راهنما
-    tg_send(chat_id, HELP_TEXT, reply_markup=tg_keyboard_default())
+    chat = msg.get("chat", {})
+    chat_id = chat.get("id")
+    user_id = msg.get("from", {}).get("id")
+    text = (msg.get("text") or "").strip()
+
+    # کاربر دوباره فعال است؛ breaker ارسال‌های گروهی برایش ریست می‌شود
+    _tg_fails.pop(chat_id, None)
+
+    # Ensure user exists (ردیف کاربر برای کل این درخواست استفاده می‌شود)
+    handler = _route(text)
+    if handler is handle_start:
+        u = await run_db(start_user, user_id, TRIAL_DAYS)
+    else:
+        u = await run_db(upsert_and_get_user, user_id)
+
+    await handler(chat_id, user_id, text, u)
     return {"ok": True}
 
 # ─────────────────────────────────────────────────────────────
 # Routes: TradingView webhook
 # ─────────────────────────────────────────────────────────────
+async def broadcast_signal(symbol: str, side: str, price: float, t: datetime):
+    # صف کردن پیام برای همه‌ی کاربران فعال و ارسال (بعد از پاسخ به TradingView اجرا می‌شود)
+    # اگر پروسه وسط کار بمیرد، باقی‌مانده در /cron بعدی ارسال می‌شود
+    try:
+        msg = format_signal_message(symbol, side, price, t, with_sltp=True)
+        if TG_SIGNALS_CHANNEL:
+            # یک پیام در کانال؛ پخش بین اعضا را خود تلگرام انجام می‌دهد
+            await tg_send(TG_SIGNALS_CHANNEL, msg)
+            return
+        users = await run_db(active_user_ids)
+        await run_db(enqueue_broadcast, users, msg, "Markdown", TG_KEYBOARD_DEFAULT_JSON)
+        await drain_outbox()
+    except Exception as e:
+        print("BROADCAST ERROR:", e, traceback.format_exc())
+
+def _parse_tv_payload(payload: TVPayload):
+    # (symbol, side, price, t, ref) یا None اگر نماد مجاز نباشد؛ جهت ناشناخته یا time نامعتبر ValueError می‌دهد
+    symbol = payload.symbol.upper()
+    side = payload.side.upper()
+    price = float(payload.price)
+    t = datetime.fromisoformat(payload.time)
+    if t.tzinfo is None:
+        t = t.replace(tzinfo=timezone.utc)
+
+    # جهت ناشناخته یعنی alert در TradingView اشتباه تنظیم شده؛ بی‌صدا رد نمی‌شود
+    if side not in VALID_SIDES:
+        raise ValueError(f"unknown side: {payload.side}")
+    if symbol not in ALLOWED_SYMBOLS:
+        return None
+
+    # CLOSE_* مرجع را از ref_open_id می‌گیرد؛ LONG/SHORT از ref ارسالی TV
+    if side in ("CLOSE_LONG", "CLOSE_SHORT"):
+        ref = payload.ref_open_id or None
+    else:
+        ref = payload.ref
+    return symbol, side, price, t, ref
+
 @app.post("/tv")
-async def tv_hook(payload: TVPayload):
+async def tv_hook(payload: TVPayload, bg: BackgroundTasks):
     try:
-        if WEBHOOK_SECRET and payload.secret != WEBHOOK_SECRET:
+        if WEBHOOK_SECRET and not secret_ok(payload.secret, WEBHOOK_SECRET):
             return JSONResponse({"detail": "invalid secret"}, status_code=403)
 
-        symbol = payload.symbol.upper()
-        side = payload.side.upper()
-        price = float(payload.price)
-        t = datetime.fromisoformat(payload.time.replace("Z", "+00:00"))
-
-        if symbol not in ALLOWED_SYMBOLS:
+        try:
+            item = _parse_tv_payload(payload)
+        except ValueError as e:
+            print("TV REJECTED:", e, payload.model_dump(exclude={"secret"}))
+            return JSONResponse({"detail": str(e)}, status_code=422)
+        if item is None:
             return {"ok": True, "ignored": "symbol not allowed"}
+        symbol, side, price, t, ref = item
 
-        # ثبت سیگنال
-        sid = insert_signal(symbol, side, price, t)
-
-        # اگر CLOSE_* است، مرجع را داشته باشیم + بسته شدن را ست کنیم + pnl
-        if side in ("CLOSE_LONG", "CLOSE_SHORT"):
-            if payload.ref_open_id:
-                update_signal_ref(sid, payload.ref_open_id)
-            set_signal_closed(sid)
-            # محاسبه‌ی PnL
-            row = {"id": sid, "side": side, "price": price, "ref_open_id": payload.ref_open_id}
-            pnl = _calc_pnl_pct_for_close(row)
-            if pnl is not None:
-                db_exec("UPDATE signals SET pnl_pct=%s WHERE id=%s", (pnl, sid))
-
-        # ارسال پیام برای همه‌ی کاربران فعال
-        users = db_exec("SELECT id FROM users WHERE expires_at IS NOT NULL AND expires_at >= NOW()")
-        msg = format_signal_message(symbol, side, price, t, with_sltp=True)
-        for u in users or []:
-            tg_send(u["id"], msg, reply_markup=tg_keyboard_default())
+        # ثبت سیگنال (به‌همراه closed_at و pnl برای CLOSE_*)
+        sid = await run_db(insert_signal, symbol, side, price, t, ref)
 
-        # اگر سیگنال باز (LONG/SHORT) بود و یک ref از طرف TV آوردی، آن ref را روی رکورد باز تنظیم کن
-        if side in ("LONG", "SHORT") and payload.ref is not None:
-            update_signal_ref(sid, payload.ref)
+        # ارسال به کاربران خارج از مسیر درخواست
+        bg.add_task(broadcast_signal, symbol, side, price, t)
 
         return {"ok": True, "id": sid}
     except Exception as e:
         print("TV ERROR:", e, traceback.format_exc())
         return JSONResponse({"detail": "server error"}, status_code=500)
 
+@app.post("/tv/batch")
+async def tv_batch_hook(payloads: list[TVPayload], bg: BackgroundTasks):
+    # چند سیگنال هم‌زمان (استراتژی چندنمادی) با یک INSERT
+    try:
+        if WEBHOOK_SECRET and not all(secret_ok(p.secret, WEBHOOK_SECRET) for p in payloads):
+            return JSONResponse({"detail": "invalid secret"}, status_code=403)
+
+        # هر آیتم جدا parse می‌شود؛ یک time خراب نباید کل دسته را با 500 رد کند
+        items, rejected = [], []
+        for i, p in enumerate(payloads):
+            try:
+                it = _parse_tv_payload(p)
+            except ValueError as e:
+                rejected.append({"index": i, "detail": str(e)})
+                continue
+            if it is not None:
+                items.append(it)
+        if rejected:
+            print("TV BATCH REJECTED:", rejected)
+        ignored = len(payloads) - len(items) - len(rejected)
+        if not items:
+            if rejected:
+                return JSONResponse({"detail": "no valid signals", "rejected": rejected}, status_code=422)
+            return {"ok": True, "ids": [], "ignored": ignored}
+
+        ids = await run_db(insert_signals, items)
+
+        for symbol, side, price, t, _ref in items:
+            bg.add_task(broadcast_signal, symbol, side, price, t)
+
+        return {"ok": True, "ids": ids, "ignored": ignored, "rejected": rejected}
+    except Exception as e:
+        print("TV BATCH ERROR:", e, traceback.format_exc())
+        return JSONResponse({"detail": "server error"}, status_code=500)
+
 # ─────────────────────────────────────────────────────────────
 # Admin (ساده)
 # ─────────────────────────────────────────────────────────────
-@app.get("/admin")
-def admin_home(token: str = Query(default="")):
-    if token != ADMIN_PANEL_TOKEN:
-        return HTMLResponse("<h3>Forbidden</h3>", status_code=403)
-
-    sigs = db_exec(
-        "SELECT id, symbol, side, price, time, created_at, ref_open_id, pnl_pct, closed_at "
-        "FROM signals ORDER BY id DESC LIMIT 50"
-    )
-    rows = []
-    for s in sigs or []:
-        rows.append(
-            f"<tr>"
-            f"<td>{s['id']}</td>"
-            f"<td>{s['symbol']}</td>"
-            f"<td>{s['side']}</td>"
-            f"<td>{format_price(s['price'])}</td>"
-            f"<td>{jalali_date_str(s['time'])}</td>"
-            f"<td>{s.get('ref_open_id') or ''}</td>"
-            f"<td>{'' if s.get('pnl_pct') is None else round(s['pnl_pct'], 2)}</td>"
-            f"<td>{'' if not s.get('closed_at') else jalali_date_str(s['closed_at'])}</td>"
-            f"</tr>"
-        )
-    html = f"""
+_ADMIN_HEAD = """
     <html><head><meta charset="utf-8"><title>Admin</title>
     <style>
-    body {{font-family: Vazirmatn, sans-serif; padding:20px;}}
-    table {{border-collapse: collapse; width:100%;}}
-    td,th {{border:1px solid #ccc; padding:6px; font-size:14px; text-align:center}}
+    body {font-family: Vazirmatn, sans-serif; padding:20px;}
+    table {border-collapse: collapse; width:100%;}
+    td,th {border:1px solid #ccc; padding:6px; font-size:14px; text-align:center}
     </style>
     </head><body>
     <h2>آخرین سیگنال‌ها</h2>
     <table>
       <tr><th>ID</th><th>Symbol</th><th>Side</th><th>Price</th><th>Time</th><th>Ref</th><th>PNL%</th><th>ClosedAt</th></tr>
-      {''.join(rows)}
+"""
+_ADMIN_TAIL = """
     </table>
+    {pager}
     </body></html>
-    """
-    return HTMLResponse(html)
+"""
+_ADMIN_ROW = (
+    "<tr><td>{id}</td><td>{symbol}</td><td>{side}</td><td>{price}</td>"
+    "<td>{time}</td><td>{ref}</td><td>{pnl}</td><td>{closed}</td></tr>"
+)
+
+_ADMIN_PAGER = '<p><a href="?{query}">صفحه‌ی بعد (قدیمی‌تر) »</a></p>'
+ADMIN_PAGE_SIZE = 50
+
+@app.get("/admin")
+def admin_home(token: str = Query(default=""), page: int = Query(default=1, ge=1, le=1000)):
+    if not secret_ok(token, ADMIN_PANEL_TOKEN):
+        return HTMLResponse("<h3>Forbidden</h3>", status_code=403)
+
+    sigs = db_exec(
+        "SELECT id, symbol, side, price, time, created_at, ref_open_id, pnl_pct, closed_at "
+        "FROM signals ORDER BY id DESC LIMIT %s OFFSET %s",
+        (ADMIN_PAGE_SIZE, (page - 1) * ADMIN_PAGE_SIZE),
+    )
+    parts = [_ADMIN_HEAD]
+    parts.extend(
+        _ADMIN_ROW.format(
+            id=s["id"],
+            symbol=escape(s["symbol"], quote=False),
+            side=escape(s["side"], quote=False),
+            price=format_price(s["price"]),
+            time=jalali_date_str(s["time"]),
+            ref=s.get("ref_open_id") or "",
+            pnl="" if s.get("pnl_pct") is None else round(s["pnl_pct"], 2),
+            closed="" if not s.get("closed_at") else jalali_date_str(s["closed_at"]),
+        )
+        for s in sigs or []
+    )
+    pager = ""
+    if sigs and len(sigs) == ADMIN_PAGE_SIZE:
+        pager = _ADMIN_PAGER.format(query=escape(urlencode({"token": token, "page": page + 1}), quote=False))
+    parts.append(_ADMIN_TAIL.format(pager=pager))
+    return HTMLResponse("".join(parts))
 
 # ─────────────────────────────────────────────────────────────
 # Cron
@@ -615,17 +1276,37 @@ def _should_send_daily_summary() -> bool:
     return (hh == 23 and 28 <= mm <= 32)  # حول‌وحوش 23:30
 
 def _daily_summary_message():
-    d1 = _stats_since_days(1)
-    # بهترین سیگنال روز (بیشترین سود مثبت)
-    best = db_exec(
-        "SELECT symbol, side, pnl_pct, closed_at FROM signals "
-        "WHERE (side='CLOSE_LONG' OR side='CLOSE_SHORT') AND pnl_pct IS NOT NULL "
-        "AND closed_at >= NOW() - INTERVAL '1 day' "
-        "ORDER BY pnl_pct DESC LIMIT 1"
+    # آمار امروز (تهران) و بهترین سیگنال روز (بیشترین سود مثبت) در یک کوئری
+    rows = db_exec(
+        f"""
+        WITH c AS (
+          SELECT symbol, side, pnl_pct
+          FROM signals
+          WHERE (side='CLOSE_LONG' OR side='CLOSE_SHORT')
+            AND pnl_pct IS NOT NULL
+            AND closed_at >= {_SQL_TEHRAN_TODAY}::timestamp AT TIME ZONE 'Asia/Tehran'
+        )
+        SELECT
+          COUNT(*)                                          AS total,
+          COUNT(*) FILTER (WHERE pnl_pct > 0)               AS wins,
+          COALESCE(SUM(pnl_pct) FILTER (WHERE pnl_pct > 0), 0) AS sum_profit_pos,
+          (SELECT row_to_json(b) FROM (
+             SELECT symbol, side, pnl_pct FROM c ORDER BY pnl_pct DESC LIMIT 1
+           ) b)                                             AS best
+        FROM c;
+        """
     )
+    r = rows[0] if rows else {}
+    total = int(r.get("total") or 0)
+    wins = int(r.get("wins") or 0)
+    d1 = {
+        "total": total,
+        "winrate": round(wins / total * 100, 1) if total else 0.0,
+        "sum_profit_pos": round(float(r.get("sum_profit_pos") or 0.0), 2),
+    }
     best_line = "—"
-    if best:
-        b = best[0]
+    b = r.get("best")
+    if b:
         best_line = f"{b['symbol']} | {side_fa(b['side'])} | +{round(b['pnl_pct'],2)}٪"
 
     msg = (
@@ -634,31 +1315,39 @@ def _daily_summary_message():
         f"• درصد موفقیت (WinRate): {d1['winrate']}٪\n"
         f"• بهترین سیگنال روز: {best_line}\n"
         f"• سود تجمعی اگر همه اجرا می‌شد: +{d1['sum_profit_pos']}٪\n"
-        "_این آمار بر اساس معاملات بسته‌شدهٔ ۲۴ ساعت اخیر محاسبه شده است._"
+        "_این آمار بر اساس معاملات بسته‌شدهٔ امروز (به وقت تهران) محاسبه شده است._"
     )
     return msg
 
 @app.get("/cron")
 @app.head("/cron")
-def cron(token: str = Query(default="")):
-    if token != CRON_TOKEN:
+async def cron(token: str = Query(default="")):
+    if not secret_ok(token, CRON_TOKEN):
         return JSONResponse({"detail": "forbidden"}, status_code=403)
 
-    # بک‌فیل PNL (در صورت نیاز)
+    # بک‌فیل PNL (در صورت نیاز) + به‌روزرسانی آمار روزانه
     try:
-        backfill_missing_pnl()
+        updated = await run_db(backfill_missing_pnl)
+        await run_db(refresh_daily_stats, bool(updated))
     except Exception:
         pass
 
     # خلاصه روزانه ساعت ۲۳:۳۰ تهران
     if _should_send_daily_summary():
-        users = db_exec("SELECT id FROM users WHERE expires_at IS NOT NULL AND expires_at >= NOW()")
+        users = await run_db(active_user_ids)
         if users:
-            msg = _daily_summary_message()
-            for u in users:
-                tg_send(u["id"], msg)
+            msg = await run_db(_daily_summary_message)
+            await run_db(enqueue_broadcast, users, msg)
 
-    return {"ok": True}
+    # ارسال باقی‌مانده‌ی صف (خلاصه‌ی روزانه یا broadcastهای نیمه‌کاره) + پاک‌سازی ردیف‌های قدیمی
+    sent = 0
+    try:
+        sent = await drain_outbox()
+        await run_db(prune_outbox)
+    except Exception as e:
+        print("OUTBOX ERROR:", e, traceback.format_exc())
+
+    return {"ok": True, "sent": sent}
 
 # ─────────────────────────────────────────────────────────────
 # Root
@@ -666,3 +1355,16 @@ def cron(token: str = Query(default="")):
 @app.get("/")
 def root():
     return JSONResponse({"status": "not found"}, status_code=404)
+
+if __name__ == "__main__":
+    # اجرای مستقیم: uvloop + httptools (هر دو در uvicorn[standard] هستند)
+    import uvicorn
+
+    uvicorn.run(
+        "main:app",
+        host="0.0.0.0",
+        port=int(os.getenv("PORT", "8000")),
+        loop="uvloop",
+        http="httptools",
+        workers=WEB_CONCURRENCY,
+    )